@@ -4,37 +4,63 @@ from pathlib import Path
 import multiprocessing
 import collections
 import subprocess
+import itertools
+import threading
+import tempfile
+import operator
+import hashlib
+import asyncio
+import inspect
 import difflib
 import filecmp
 import pprint
 import random
-import string
+import signal
+import shutil
+import shlex
+import queue
+import json
 import time
+import sys
 import re
 import os
 
-try:
-    from tqdm import tqdm
-except ImportError as e:
-    def tqdm(it, total=None):
-        if total is None:
-            total = it.__length_hint__()
-        def p(i): return round(i/total*100)
-        for i, x in enumerate(it):
-            if p(i) != p(i-1):
-                print("{: >3}%...".format(p(i)), end="\r")
-            yield x
-        print("100%... done")
-
-try:
-    import colorama
-    colorama.init()
-    Fore, Back, Style = colorama.Fore, colorama.Back, colorama.Style
-except ImportError as e:
-    class Fakerama:
-        def __getattribute__(self, attr):
-            return ''
-    Fore, Back, Style = Fakerama(), Fakerama(), Fakerama()
+# Progress bars and colors are only worth their import time on a terminal.
+# Progress goes to stderr, so it never mixes with the results.
+def simple_progress(it, total=None):
+    if total is None:
+        total = it.__length_hint__()
+    def p(i): return round(i/total*100)
+    for i, x in enumerate(it):
+        if p(i) != p(i-1):
+            print("{: >3}%...".format(p(i)), end="\r", file=sys.stderr)
+        yield x
+    print("100%... done", file=sys.stderr)
+
+def no_progress(it, total=None):
+    return it
+
+def progress_bar():
+    if not sys.stderr.isatty():
+        return no_progress
+    try:
+        from tqdm import tqdm
+        return tqdm
+    except ImportError as e:
+        return simple_progress
+
+class Fakerama:
+    def __getattribute__(self, attr):
+        return ''
+Fore, Back, Style = Fakerama(), Fakerama(), Fakerama()
+
+if sys.stdout.isatty():
+    try:
+        import colorama
+        colorama.init()
+        Fore, Back, Style = colorama.Fore, colorama.Back, colorama.Style
+    except ImportError as e:
+        pass
 
 import click
 
@@ -42,9 +68,16 @@ import click
 # which is a random temporary filename. The file is always deleted after
 # leaving the function.
 def temp_filename(suffix='.tmp', dlen=4):
-    d = "".join(random.choice(string.hexdigits) for _ in range(dlen))
-    return d + suffix
+    return os.urandom((dlen + 1) // 2).hex()[:dlen] + suffix
 def with_temporary_file(func, suffix='.tmp', dlen=6):
+    if inspect.iscoroutinefunction(func):
+        async def wrapped(*args, **kwargs):
+            tmp = temp_filename(suffix, dlen)
+            try:
+                return await func(*args, tmp, **kwargs)
+            finally:
+                os.remove(tmp)
+        return wrapped
     def wrapped(*args, **kwargs):
         tmp = temp_filename(suffix, dlen)
         try:
@@ -54,19 +87,91 @@ def with_temporary_file(func, suffix='.tmp', dlen=6):
     return wrapped
 
 
+# Scratch file: on Linux, a process writes program output to a single
+# anonymous file (O_TMPFILE), truncated before every case, instead of
+# creating and deleting a temporary file per case. It is reachable through
+# its /proc path, including from checker processes.
+ScratchFile = collections.namedtuple('ScratchFile', ['pid', 'fd', 'path'])
+
+process_scratch = None
+def scratch_file():
+    global process_scratch
+    if not hasattr(os, 'O_TMPFILE'):
+        return None
+    if process_scratch is None or process_scratch.pid != os.getpid():
+        try:
+            fd = os.open(tempfile.gettempdir(), os.O_TMPFILE | os.O_RDWR, 0o600)
+        except OSError:
+            # Not supported by the filesystem
+            return None
+        pid = os.getpid()
+        process_scratch = ScratchFile(pid, fd, '/proc/{}/fd/{}'.format(pid, fd))
+    os.ftruncate(process_scratch.fd, 0)
+    os.lseek(process_scratch.fd, 0, os.SEEK_SET)
+    return process_scratch
+
+def discard_scratch_file():
+    global process_scratch
+    if process_scratch is not None and process_scratch.pid == os.getpid():
+        os.close(process_scratch.fd)
+    process_scratch = None
+
+
+# Only this many lines from both ends of the outputs are diffed, as
+# SequenceMatcher is quadratic in the worst case and a huge diff isn't
+# printed in full anyway. The head and the tail are diffed separately,
+# with indices still counted from the start of the outputs.
+diff_window = 2000
+
+# Returns the parts of `a` and `b` to diff, along with their offset.
+def diff_windows(a, b, window=diff_window):
+    if max(len(a), len(b)) <= 2*window:
+        return [(0, a, b)]
+    # Both tails start at the same line, so that lines appended to either
+    # output show up as such
+    t = max(window, min(len(a), len(b)) - window)
+    return [(0, a[:window], b[:window]), (t, a[t:], b[t:])]
+
 def result_diff(expected, got):
     a, b = expected.splitlines(), got.splitlines()
-    s = difflib.SequenceMatcher(None, a, b)
     r = ''
-    for tag, i1, i2, j1, j2 in s.get_opcodes():
-        if tag == 'equal':
-            continue
-        r += '{:7}   a[{}:{}] --> b[{}:{}] {!r:>8} --> {!r}\n'.format(
-            tag, i1, i2, j1, j2, a[i1:i2], b[j1:j2]
-        )
+    for k, x, y in diff_windows(a, b):
+        if k:
+            r += '[..middle of the outputs not compared..]\n'
+        s = difflib.SequenceMatcher(None, x, y)
+        for tag, i1, i2, j1, j2 in s.get_opcodes():
+            if tag == 'equal':
+                continue
+            r += '{:7}   a[{}:{}] --> b[{}:{}] {!r:>8} --> {!r}\n'.format(
+                tag, k+i1, k+i2, k+j1, k+j2, x[i1:i2], y[j1:j2]
+            )
     return r
 
 
+def read_file(path):
+    with open(path) as file:
+        return file.read()
+
+# Yields whitespace-separated tokens of a file without reading it whole.
+# Outputs bigger than the threshold are compared this way: it is as fast as
+# splitting them whole, and keeps memory use flat.
+stream_threshold = 1 << 20
+
+def iter_tokens(path, chunk=65536):
+    with open(path) as file:
+        rest = ''
+        while True:
+            data = file.read(chunk)
+            if not data:
+                break
+            tokens = (rest + data).split()
+            # The last token may continue in the next chunk
+            rest = '' if data[-1].isspace() else tokens.pop()
+            yield from tokens
+        if rest:
+            yield rest
+
+
 # Verifiers are objects that take care of testing singular cases.
 # All of them run the app, but they have different ways of deciding
 # if the result is correct. A VerifyStatus object should be a summary
@@ -75,38 +180,210 @@ def result_diff(expected, got):
 VerifyStatus = collections.namedtuple('VerifyStatus', ['ok', 'time', 'case', 'meta'])
 # `ok` is `True` if everything was correct, `False` if the result is wrong,
 # None otherwise (reason should be specified in `meta`)
-# `case` is the case name (stem of the input file), `time` is the time taken.
+# `case` is the case name (stem of the input file), `time` is the time taken
+# in nanoseconds.
+
+# Commands containing any of these, or starting with an environment
+# assignment, need a shell to be interpreted. So do commands whose first
+# word isn't a program the kernel can execute by itself: shell builtins,
+# missing programs (for the shell's error) and scripts without a shebang.
+# Everything else gets executed directly.
+shell_metacharacters = re.compile(r'[|&;<>$`()*?~{}\[\]!#\\\n]')
+env_assignment = re.compile(r'[A-Za-z_][A-Za-z0-9_]*=')
+executable_magic = (
+    b'#!', b'\x7fELF',
+    b'\xfe\xed\xfa\xce', b'\xfe\xed\xfa\xcf', b'\xce\xfa\xed\xfe',
+    b'\xcf\xfa\xed\xfe', b'\xca\xfe\xba\xbe'
+)
+
+def directly_executable(word):
+    path = word if os.path.dirname(word) else shutil.which(word)
+    if path is None or not os.path.isfile(path) or not os.access(path, os.X_OK):
+        return False
+    elif os.name == 'nt':
+        return True
+    try:
+        with open(path, 'rb') as file:
+            return file.read(4).startswith(executable_magic)
+    except OSError:
+        return False
+
+# Returns the command (with extra arguments `args`) as something to pass
+# to subprocess, and whether it needs a shell.
+def command_argv(command, args=()):
+    argv, shell = split_command(command)
+    if shell:
+        return argv + ''.join(' ' + shlex.quote(arg) for arg in args), True
+    return argv + list(args), False
+
+def split_command(command):
+    if not isinstance(command, str):
+        return list(command), False
+    elif directly_executable(command):
+        # The path of the program itself, which may contain spaces
+        return [command], False
+    elif shell_metacharacters.search(command):
+        return command, True
+    try:
+        argv = shlex.split(command)
+    except ValueError:
+        # Unbalanced quotes, let the shell complain
+        return command, True
+    if not argv or env_assignment.match(argv[0]) or not directly_executable(argv[0]):
+        return command, True
+    return argv, False
+
+# Apps are started in their own session, so that killing the process group
+# also takes care of anything they (or a shell in between) have spawned.
+# This is done after every run, so that nothing left behind by an app can
+# write into the output of the next case.
+def kill_app(pid):
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(pid, signal.SIGKILL)
+        else:
+            os.kill(pid, signal.SIGTERM)
+    except OSError:
+        pass
+
+# The app a process is currently waiting for, if any. While an app is being
+# started, its pid is not known yet, so termination is put off until it is.
+running_app = None
+starting_app, terminating = False, False
+
+def start_app(*args, **kwargs):
+    global running_app, starting_app
+    starting_app = True
+    try:
+        process = subprocess.Popen(*args, start_new_session=True, **kwargs)
+        running_app = process.pid
+    finally:
+        starting_app = False
+        if terminating:
+            terminate_worker(signal.SIGTERM, None)
+    return process
 
 class Verifier:
-    def __init__(self, app, in_path, out_path=None, checker=None, timeout=600):
+    def __init__(self, app, in_path, out_path=None, checker=None, timeout=600, checker_server=False):
         self.app, self.in_path, self.out_path = app, in_path, out_path
         self.checker, self.timeout = checker, timeout
+        self.checker_server = checker_server
+        self.argv, self.shell = command_argv(app)
 
+    # Plain strings are enough for os.open and subprocess, and are
+    # much cheaper to build than Path objects.
     def input_of(self, case):
-        return Path(str(self.in_path / case) + '.in')
+        return os.path.join(self.in_path, case + '.in')
 
     def output_of(self, case):
-        return Path(str(self.out_path / case) + '.out')
+        return os.path.join(self.out_path, case + '.out')
 
     def verify(self, case):
         return NotImplemented
 
+    def __call__(self, case):
+        scratch = scratch_file()
+        if scratch is None:
+            return self.run_in_temporary_file(case)
+        return self.run(case, scratch.fd, scratch.path)
+
     @with_temporary_file
-    def __call__(self, case, got):
-        # got is a temporary file for program output
+    def run_in_temporary_file(self, case, got):
+        out_fd = os.open(got, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
         try:
-            start = time.time()
-            process = subprocess.run(
-                self.app, shell=True, timeout=2*self.timeout, check=True,
-                stdin=open(self.input_of(case), 'rb'), stdout=open(got, 'wb')
-            )
-            end = time.time()
+            return self.run(case, out_fd, got)
+        finally:
+            os.close(out_fd)
+
+    def open_input(self, case):
+        # A raw descriptor is enough for the child
+        in_fd = os.open(self.input_of(case), os.O_RDONLY)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(in_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        return in_fd
+
+    def run(self, case, out_fd, got):
+        global running_app
+        # got is the path of the file behind out_fd, for program output
+        in_fd = None
+        try:
+            in_fd = self.open_input(case)
+            start = time.monotonic_ns()
+            process = start_app(self.argv, shell=self.shell, stdin=in_fd, stdout=out_fd)
+            try:
+                process.wait(timeout=2*self.timeout)
+            except BaseException:
+                # Timed out, or interrupted
+                kill_app(process.pid)
+                process.wait()
+                raise
+            finally:
+                running_app = None
+            end = time.monotonic_ns()
+            if hasattr(os, 'killpg'):
+                kill_app(process.pid)
         except subprocess.TimeoutExpired as e:
-            return VerifyStatus(None, 2*self.timeout, case, {'timeout': True, 'code': None})
-        except subprocess.CalledProcessError as e:
-            return VerifyStatus(None, round(time.time() - start, 6), case, {'timeout': False, 'code': e.returncode})
+            # The process group is gone, but don't reuse the scratch file
+            # in case something escaped it
+            discard_scratch_file()
+            return VerifyStatus(None, int(2*self.timeout*1e9), case, {'timeout': True, 'code': None})
+        except OSError as e:
+            # Without a shell in between, a missing app is reported here
+            return VerifyStatus(None, 0, case, {'timeout': False, 'code': None, 'error': str(e)})
+        finally:
+            if in_fd is not None:
+                os.close(in_fd)
+
+        if process.returncode != 0:
+            return VerifyStatus(None, end - start, case, {'timeout': False, 'code': process.returncode})
+        return self.finish(case, got, process.returncode, end - start)
 
-        meta = {'timeout': end-start > self.timeout, 'code': process.returncode}
+    # Version for asyncio: many cases may be run at once from the same
+    # process, so each gets its own temporary file.
+    @with_temporary_file
+    async def arun(self, case, got):
+        in_fd = out_fd = None
+        try:
+            out_fd = os.open(got, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            in_fd = self.open_input(case)
+            start = time.monotonic_ns()
+            if self.shell:
+                spawn = asyncio.create_subprocess_shell(
+                    self.argv, stdin=in_fd, stdout=out_fd, start_new_session=True
+                )
+            else:
+                spawn = asyncio.create_subprocess_exec(
+                    *self.argv, stdin=in_fd, stdout=out_fd, start_new_session=True
+                )
+            process = await spawn
+            try:
+                await asyncio.wait_for(process.wait(), 2*self.timeout)
+            except BaseException:
+                # Timed out, or the run was cancelled
+                kill_app(process.pid)
+                await process.wait()
+                raise
+            end = time.monotonic_ns()
+            if hasattr(os, 'killpg'):
+                kill_app(process.pid)
+        except asyncio.TimeoutError as e:
+            return VerifyStatus(None, int(2*self.timeout*1e9), case, {'timeout': True, 'code': None})
+        except OSError as e:
+            return VerifyStatus(None, 0, case, {'timeout': False, 'code': None, 'error': str(e)})
+        finally:
+            for fd in (in_fd, out_fd):
+                if fd is not None:
+                    os.close(fd)
+
+        if process.returncode != 0:
+            return VerifyStatus(None, end - start, case, {'timeout': False, 'code': process.returncode})
+        # Verifiers are blocking (the checker is a process too), so they
+        # are kept off the event loop.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.finish, case, got, process.returncode, end - start)
+
+    def finish(self, case, got, code, elapsed):
+        meta = {'timeout': elapsed > self.timeout*1e9, 'code': code}
         v = self.verify(case, got)
         # In the simple case, verify returns only the status (`ok`). Otherwise,
         # it is a dictionary containing the status and metadata.
@@ -115,37 +392,111 @@ class Verifier:
             del meta['ok']
             v = v['ok']
 
-        return VerifyStatus(v, round(end - start, 6), case, meta)
+        return VerifyStatus(v, elapsed, case, meta)
 
 
 class IdenticalOutputVerifier(Verifier):
     def verify(self, case, got):
-        if filecmp.cmp(got, self.output_of(case)):
+        expected = self.output_of(case)
+        if filecmp.cmp(got, expected, shallow=True):
             return True
         else:
-            a = open(self.output_of(case)).read()
-            b = open(got).read()
+            a, b = read_file(expected), read_file(got)
             return {'ok': False, 'diff': result_diff(a, b)}
 
 
 class LooseOutputVerifier(Verifier):
     def verify(self, case, got):
-        a = open(self.output_of(case)).read()
-        b = open(got).read()
-        if a.split() == b.split():
+        expected = self.output_of(case)
+        if os.path.getsize(expected) > stream_threshold:
+            pairs = itertools.zip_longest(iter_tokens(expected), iter_tokens(got))
+            ok = all(itertools.starmap(operator.eq, pairs))
+        else:
+            ok = read_file(expected).split() == read_file(got).split()
+        if ok:
             return True
         else:
+            a, b = read_file(expected), read_file(got)
             diff = difflib.context_diff(a, b, fromfile='expected', tofile='got')
             return {'ok': False, 'diff': result_diff(a, b)}
 
+# A long-lived checker, started on the first query. Every case is a line on
+# its stdin, with the same filenames as the checker's usual arguments
+# separated by tabs. The answer is a line with the status code, optionally
+# followed by a tab and a comment. A checker which doesn't answer in time,
+# or answers something else, is not a checker server and is not asked again.
+class Checker:
+    def __init__(self, command, timeout=600):
+        self.command, self.timeout = command, timeout
+        self.process, self.quit = None, False
+        self.lock = threading.Lock()
+
+    def start(self):
+        argv, shell = command_argv(self.command)
+        self.process = subprocess.Popen(
+            argv, shell=shell, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True
+        )
+        # Replies are read by a thread, so that waiting for one can time out
+        self.replies = queue.Queue()
+        threading.Thread(target=self.read_replies, args=(self.process.stdout, self.replies), daemon=True).start()
+
+    @staticmethod
+    def read_replies(stdout, replies):
+        for line in stdout:
+            replies.put(line)
+        replies.put('')
+
+    def close(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            self.process.kill()
+            self.process.wait()
+            self.process = None
+        self.quit = True
+
+    # Returns the status code and the comment, or None if the checker quit.
+    def query(self, param):
+        with self.lock:
+            if self.quit:
+                return None
+            if self.process is None:
+                self.start()
+            try:
+                self.process.stdin.write('\t'.join(param) + '\n')
+                self.process.stdin.flush()
+                reply = self.replies.get(timeout=self.timeout)
+            except (BrokenPipeError, queue.Empty):
+                reply = ''
+            code, _, comment = reply.rstrip('\n').partition('\t')
+            try:
+                return int(code), comment
+            except ValueError:
+                self.close()
+                return None
+
+
 # TODO: test this
 class CheckerVerifier(Verifier):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.server = Checker(self.checker, self.timeout) if self.checker_server else None
+
     def verify(self, case, got):
-        param = [self.checker, self.input_of(case), got]
+        param = [self.input_of(case), got]
         if self.out_path is not None:
             param.append(self.output_of(case))
         param = [str(x) for x in param]
-        process = subprocess.run(param, timeout=self.timeout, capture_output=True)
+        reply = self.server.query(param) if self.server is not None else None
+        if reply is not None:
+            code, comment = reply
+            return {'ok': code == 0, 'checkcode': code, 'comment': comment}
+        # Not a checker server after all, so it is run for every case
+        argv, shell = command_argv(self.checker, param)
+        process = subprocess.run(argv, shell=shell, timeout=self.timeout, capture_output=True)
         return {'ok': process.returncode == 0, 'checkcode': process.returncode, 'comment': process.stdout.decode()}
 
 
@@ -156,17 +507,32 @@ available_verifiers = {
 }
 
 
-# Input filenames are sorted using these.
+# Input files are listed as directory entries, which keep their stat
+# result once it is needed, and are sorted using these.
+
+def enumerate_inputs(path):
+    with os.scandir(path) as it:
+        return [entry for entry in it if entry.name.endswith('.in') and entry.is_file()]
+
+def entry_name(entry):
+    return entry.name
+
+def case_name(entry):
+    return entry.name[:-len('.in')]
+
+def lexicographical_sort(it):
+    return sorted(it, key=entry_name)
 
 def tryint(x):
     try:
         return int(x)
     except:
         return x
+digit_runs = re.compile('([0-9]+)')
 def nkey(x):
-    return tuple(tryint(c) for c in re.split('([0-9]+)', str(x)))
+    return tuple(tryint(c) for c in digit_runs.split(str(x)))
 def natural_sort(it):
-    return sorted(it, key=nkey)
+    return sorted(it, key=lambda entry: nkey(case_name(entry)))
 
 def shuffled(it):
     it = list(it)
@@ -174,39 +540,27 @@ def shuffled(it):
     return it
 
 def filesize_sort(it):
-    return sorted(it, key=os.path.getsize)
+    return sorted(it, key=lambda entry: entry.stat().st_size)
 
 available_orderings = {
-    'lexicographical': sorted,
+    'lexicographical': lexicographical_sort,
     'natural': natural_sort,
     'random': shuffled,
     'size': filesize_sort
 }
 
 
-# Finds the string in `it` which has the longest common prefix with `string`
+# Finds the only string in `it` which starts with `string`,
 # or decides that there is no good result.
 def find_prefixwise(it, string):
-    dec = []
-    for key in it:
-        if len(key) < len(string):
-            continue
-        elif string == key:
-            return string
-        k = 0
-        while k < len(string):
-            if key[k] == string[k]:
-                k += 1
-            else:
-                break
-        dec.append((k, key))
-    dec.sort()
-    if all(k == 0 for k, _ in dec):
+    matches = [key for key in it if key.startswith(string)]
+    if string in matches:
+        return string
+    elif len(matches) == 1:
+        return matches[0]
+    elif not matches:
         raise ValueError("No matching key for `{}`".format(string))
-    if len(dec) >= 2 and dec[-2][0] == dec[-1][0]:
-        same = [key for k, key in dec if k == dec[-1][0]]
-        raise ValueError("Ambiguous prefix `{}` of {}".format(string, same))
-    return dec[-1][1]
+    raise ValueError("Ambiguous prefix `{}` of {}".format(string, matches))
 
 # Handles the verifier doing all the work.
 def verify_job(cases, verifier, verbose):
@@ -220,9 +574,104 @@ process_verifier = None
 def initialize_worker(vertype, param):
     global process_verifier
     process_verifier = vertype(*param)
+    signal.signal(signal.SIGTERM, terminate_worker)
+    signal.signal(signal.SIGINT, terminate_worker)
+
+# Workers are terminated when testing stops early, or interrupted along with
+# the main process. The app runs in another session, so it has to be killed
+# by hand.
+def terminate_worker(signum, frame):
+    global terminating
+    if starting_app:
+        terminating = True
+        return
+    if running_app is not None:
+        kill_app(running_app)
+    os._exit(1)
+
+def verify_batch(batch):
+    return [process_verifier(case) for case in batch]
+
+# Version for asyncio: a single process starts the apps and waits for them,
+# with at most `concurrency` of them running at once.
+def verify_job_async(cases, verifier, concurrency):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    async def start():
+        semaphore = asyncio.Semaphore(concurrency)
+        async def verify_one(case):
+            async with semaphore:
+                return await verifier.arun(case)
+        return {asyncio.ensure_future(verify_one(case)) for case in cases}
+
+    pending = loop.run_until_complete(start())
+    try:
+        while pending:
+            done, pending = loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            )
+            for task in done:
+                yield task.result()
+    finally:
+        # Stopped early, kill whatever is still running
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.wait(pending))
+        loop.close()
+        asyncio.set_event_loop(None)
+
+# Results cache: a stored status is reused as long as the app, its
+# settings and the files of the case are unchanged. Statuses that timed out
+# or could not run are never stored.
+cache_filename = '.taucheck-cache.json'
+
+def file_digest(path, chunk=65536):
+    h = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for data in iter(lambda: file.read(chunk), b''):
+            h.update(data)
+    return h.hexdigest()
+
+# Hashes the command along with every file it mentions (like a script
+# passed to an interpreter), and the executable it runs.
+def app_digest(app):
+    h = hashlib.sha256(str(app).encode())
+    try:
+        words = shlex.split(app) if isinstance(app, str) else list(app)
+    except ValueError:
+        words = []
+    for i, word in enumerate(words):
+        path = word if os.path.isfile(word) else (shutil.which(word) if i == 0 else None)
+        if path is not None:
+            h.update(file_digest(path).encode())
+    return h.hexdigest()
+
+def stat_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+def cache_key(prefix, verifier, case):
+    sig = (stat_signature(verifier.input_of(case)), stat_signature(verifier.output_of(case)))
+    return json.dumps([prefix, case, sig])
+
+def load_cache(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
 
-def verify_single(case):
-    return process_verifier(case)
+def save_cache(path, cache):
+    with open(path, 'w') as file:
+        json.dump(cache, file)
+
+def cacheable(status):
+    return not status.meta['timeout'] and 'error' not in status.meta
 
 
 def test_status_acronym(status):
@@ -248,13 +697,15 @@ def print_summary(stati, verbose):
         if not verbose and s.ok:
             continue
         code = s.meta['code'] if 'code' in s.meta and s.meta['code'] is not None else '??'
-        print("- {} {} ({: >6.3f}s) -> {}{}".format(test_status_acronym(s), s.case, s.time, code, " (check: {})".format(s.meta['checkcode']) if 'checkcode' in s.meta else ""))
+        print("- {} {} ({: >6.3f}s) -> {}{}".format(test_status_acronym(s), s.case, s.time / 1e9, code, " (check: {})".format(s.meta['checkcode']) if 'checkcode' in s.meta else ""))
         if verbose:
             if 'diff' in s.meta:
                 if len(s.meta['diff']) > 512:
                     print("[..diff too long, snip..]")
                 else:
                     pprint.pprint(s.meta['diff'])
+            if 'error' in s.meta:
+                print("Could not run: {}".format(s.meta['error']))
             if 'comment' in s.meta and s.meta['comment']:
                 print("Checker (code {}) comment:".format(s.meta['checkcode']))
                 print(s.meta['comment'])
@@ -268,16 +719,20 @@ def print_summary(stati, verbose):
 @click.option('-d', '--order', 's_order', default='natural', help="Test ordering: lexicographical, [natural], random, filesize. Supports prefix completion.")
 @click.option('-e', '--verify', 's_verify', default='loose', help="Verifier: identical, [loose], checker. Loose verification compares only words (whitespace-separated strings). Supports prefix completion.")
 @click.option('-c', '--checker', default=None, help="Checker program. Should take input filename, expected out filename and received out filename as arguments and return a nonzero status code if the output is not correct.")
+@click.option('-s', '--checker-server', default=False, is_flag=True, help="Start the checker once per process and pass it cases on stdin: a line of tab-separated filenames, in the same order as arguments. It should answer each with a line holding the status code, optionally followed by a tab and a comment.")
 @click.option('-t', '--timeout', default=600, type=float, help="Program timeout length.")
 @click.option('-p', '--processes', default=1, type=int, help="Enable multiprocessing with given process count.")
+@click.option('-a', '--asynchronous', default=False, is_flag=True, help="Run cases from a single process with asyncio, as many at once as the process count.")
+@click.option('-b', '--batch-size', default=1, type=click.IntRange(min=1), help="Number of cases handed to a process at once.")
+@click.option('--cache/--no-cache', default=False, help="Reuse results of unchanged cases from previous runs, stored in {}.".format(cache_filename))
 @click.option('-f', '--fatal', default=False, is_flag=True, help="Stop testing when a non-ok status is encountered.")
 @click.option('-v', '--verbose', default=0, count=True, help="Controls verbosity level.")
-def main(app, tests, outputs, s_order, s_verify, checker, timeout, processes, fatal, verbose):
+def main(app, tests, outputs, s_order, s_verify, checker, checker_server, timeout, processes, asynchronous, batch_size, cache, fatal, verbose):
     """
     Test the program APP using test cases provided in the TESTS directory.
     """
 
-    start = time.time()
+    start = time.monotonic()
 
     s_verify = find_prefixwise(available_verifiers.keys(), s_verify)
     s_order = find_prefixwise(available_orderings.keys(), s_order)
@@ -290,42 +745,72 @@ def main(app, tests, outputs, s_order, s_verify, checker, timeout, processes, fa
     if checker and s_verify != 'checker':
         print("[?] Checker parameter provided but verifier is not checker.")
 
-    verifier_params = (app, in_path, out_path, checker, timeout)
+    verifier_params = (app, in_path, out_path, checker, timeout, checker_server)
 
-    inputs = order(in_path.glob('*.in'))
-    cases = [i.stem for i in inputs]
+    inputs = order(enumerate_inputs(in_path))
+    cases = [case_name(entry) for entry in inputs]
 
     stati = []
-    job = None
-    pool = None
-
-    # Prepare job
-    if processes == 1:
-        job = verify_job(cases, verifier_t(*verifier_params), verbose)
+    cached, pending, keys = [], cases, {}
+    if cache:
+        results = load_cache(cache_filename)
+        prefix = [app_digest(app), s_verify, checker and app_digest(checker), checker_server, timeout]
+        verifier = verifier_t(*verifier_params)
+        keys = {case: cache_key(prefix, verifier, case) for case in cases}
+        cached = [VerifyStatus(*results[keys[case]]) for case in cases if keys[case] in results]
+        pending = [case for case in cases if keys[case] not in results]
+        if cached:
+            print("[*] Reusing cached results of {} cases.".format(len(cached)))
+
+    # Returns whether testing was stopped early.
+    def collect(job):
+        job = itertools.chain(cached, job)
+        progress = progress_bar()
+        for status in progress(job, total=len(cases)):
+            stati.append(status)
+            if not status.ok and fatal:
+                print("!@#")
+                return True
+        return False
+
+    if asynchronous:
+        collect(verify_job_async(pending, verifier_t(*verifier_params), processes))
+    elif processes == 1:
+        collect(verify_job(pending, verifier_t(*verifier_params), verbose))
     else:
         # A worker gets a verifier instance, so we don't
-        # recreate it needlessly
-        def winit():
-            return initialize_worker(verifier_t, verifier_params)
-        pool = multiprocessing.Pool(processes, initializer=winit)
-        job = pool.imap_unordered(verify_single, cases)
-
-    job = tqdm(job, total=len(cases))
-
-    for status in job:
-        if not status.ok and fatal:
-            print("!@#")
-            break
-        stati.append(status)
-
-    if pool is not None:
-        pool.close()
+        # recreate it needlessly. Cases are handed out in small batches,
+        # so a single slow case doesn't hold back the others.
+        batches = [pending[i:i+batch_size] for i in range(0, len(pending), batch_size)]
+        with multiprocessing.Pool(processes, initializer=initialize_worker,
+                                  initargs=(verifier_t, verifier_params)) as pool:
+            statuses = pool.imap_unordered(verify_batch, batches, chunksize=1)
+            if collect(itertools.chain.from_iterable(statuses)):
+                # Don't wait for the remaining cases, kill them
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+    if cache:
+        # Only entries for the current cases are kept around
+        results = {key: results[key] for key in keys.values() if key in results}
+        for s in stati:
+            if cacheable(s):
+                results[keys[s.case]] = list(s)
+            else:
+                results.pop(keys[s.case], None)
+        save_cache(cache_filename, results)
 
     correct = sum(bool(s.ok) for s in stati)
     total = len(stati)
     print("Correct: {}/{} ({}%)".format(correct, total, round(correct/total*100, 1)))
 
-    stati.sort(key=lambda s: nkey(s.case))
+    # The summary follows natural order of case names, which the cases may
+    # already be in
+    ordered_cases = cases if s_order == 'natural' else sorted(cases, key=nkey)
+    order_idx = {case: i for i, case in enumerate(ordered_cases)}
+    stati.sort(key=lambda s: order_idx[s.case])
 
     if correct == total:
         print(Fore.GREEN + Style.BRIGHT + "AC! :)" + Style.RESET_ALL)
@@ -333,7 +818,7 @@ def main(app, tests, outputs, s_order, s_verify, checker, timeout, processes, fa
     if verbose or correct != total:
         print_summary(stati, verbose)
 
-    end = time.time()
+    end = time.monotonic()
 
     print("Done in {:.3f}s".format(end - start))
 